@@ -1,8 +1,11 @@
+import re
+from typing import Optional
+
 import streamlit as st
 import gspread
+import numpy as np
 import pandas as pd
 import plotly.express as px
-from dateutil.relativedelta import relativedelta
 
 # カスタムCSS（変更なし）
 st.markdown(
@@ -52,58 +55,249 @@ st.markdown("""
 """)
 
 # 日付から営業期を判定する関数
-def get_fiscal_period(date):
+def get_fiscal_period(dates: pd.Series) -> pd.Categorical:
     """
-    日付を受け取り、4月始まりの年度から「第X期」という文字列を返す。
-    2023/4/1 ~ 2024/3/31 を 第1期 とする。
+    日付の列を受け取り、4月始まりの年度から「第X期」という文字列の列を返す。
+    2023/4/1 ~ 2024/3/31 を 第1期 とする。日付が欠損している行は欠損のまま。
     """
-    if pd.isna(date):
-        return None
-    fiscal_year = date.year if date.month >= 4 else date.year - 1
+    months = dates.dt.month.fillna(0).to_numpy(dtype=np.int64)
+    years = dates.dt.year.fillna(0).to_numpy(dtype=np.int64)
+    fiscal_year = np.where(months >= 4, years, years - 1)
     period_number = fiscal_year - 2022
-    if period_number > 0:
-        return f"第{period_number}期"
-    return "対象期間外"
+    labels = np.where(
+        period_number > 0,
+        np.char.add(np.char.add("第", period_number.astype(str)), "期"),
+        "対象期間外",
+    ).astype(object)
+    labels[dates.isna().to_numpy()] = None
+    return pd.Categorical(labels)
 
-@st.cache_data(ttl=600)
-def load_and_process_data(sheet_name: str) -> pd.DataFrame:
-    """Googleスプレッドシートからデータを読み込み、前処理を行う"""
+@st.cache_resource
+def get_gspread_client() -> gspread.Client:
+    """認証済みのgspreadクライアントを作成し、セッションをまたいで使い回す"""
     creds = st.secrets["gcp_service_account"]
-    gc = gspread.service_account_from_dict(creds)
+    return gspread.service_account_from_dict(creds)
+
+@st.cache_resource
+def get_worksheet(sheet_name: str) -> gspread.Worksheet:
+    """スプレッドシートの先頭シートを開き、各ローダーで使い回す"""
+    gc = get_gspread_client()
     sh = gc.open(sheet_name)
-    worksheet = sh.get_worksheet(0)
-    
-    data = worksheet.get_all_records()
-    df = pd.DataFrame(data)
+    return sh.get_worksheet(0)
+
+def get_current_fiscal_start() -> pd.Timestamp:
+    """今日が属する営業期の開始日（4月1日）を返す"""
+    today = pd.Timestamp.today()
+    fiscal_year = today.year if today.month >= 4 else today.year - 1
+    return pd.Timestamp(year=fiscal_year, month=4, day=1)
+
+# 金額セルから取り除く文字（通貨記号・桁区切り・空白）
+_CURRENCY_RE = re.compile(r'[¥,\s]')
+
+# ダッシュボードで使う列（これ以外の列はシートから取得しない）
+USED_COLUMNS = [
+    '管理No.', '受注月', '納品月', '売上（税抜）', '粗利（税抜）',
+    '商流', '案件フェーズ', '担当者', '営業担当',
+]
 
-    if '管理No.' in df.columns:
-        df = df[df['管理No.'].astype(str).str.strip() != ''].copy()
+# 締め済みの期の行はほぼ変わらないため長め、進行中の期の行は短めにキャッシュする
+CLOSED_PERIOD_TTL = 24 * 60 * 60
+CURRENT_PERIOD_TTL = 300
 
-    # --- データ処理 ---
-    df["受注月"] = pd.to_datetime(df["受注月"], errors="coerce")
-    df["納品月"] = pd.to_datetime(df["納品月"], errors="coerce")
+def convert_sheet_types(df: pd.DataFrame) -> pd.DataFrame:
+    """シートから読み込んだ文字列のままの列を、日付・金額の型に変換する"""
+    df["受注月"] = pd.to_datetime(df["受注月"], errors="coerce", cache=True)
+    df["納品月"] = pd.to_datetime(df["納品月"], errors="coerce", cache=True)
 
     currency_columns = ['売上（税抜）', '粗利（税抜）']
     for col in currency_columns:
         if col in df.columns:
-            df[col] = df[col].replace(r'^\s*$', None, regex=True)
-            df[col] = df[col].astype(str).str.replace('[¥,]', '', regex=True)
-            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-
-    df["受注期"] = df["受注月"].apply(get_fiscal_period)
-    df["納品期"] = df["納品月"].apply(get_fiscal_period)
+            values = df[col].to_numpy()
+            if values.dtype == object:
+                # 記号と空白を除去（空欄は空文字になり、数値変換で欠損→0になる）
+                values = np.fromiter(
+                    (_CURRENCY_RE.sub('', v) if isinstance(v, str) else v for v in values),
+                    dtype=object, count=len(values),
+                )
+            df[col] = pd.to_numeric(values, errors='coerce')
+            # 金額は円単位の整数として持つ
+            df[col] = df[col].fillna(0).round().astype(np.int64)
     return df
 
+def column_letters(header: list) -> tuple:
+    """ヘッダー行から、ダッシュボードで使う列の (列名, 列記号) の組を作る"""
+    letters = {}
+    for i, name in enumerate(header):
+        if name in USED_COLUMNS:
+            letters.setdefault(name, gspread.utils.rowcol_to_a1(1, i + 1).rstrip("0123456789"))
+    return tuple(letters.items())
+
+@st.cache_data(ttl=CLOSED_PERIOD_TTL)
+def load_column_letters(sheet_name: str) -> tuple:
+    """ヘッダー行を読み、ダッシュボードで使う列の (列名, 列記号) の組を返す"""
+    worksheet = get_worksheet(sheet_name)
+    return column_letters(worksheet.row_values(1))
+
+def fetch_columns(worksheet: gspread.Worksheet, columns: tuple, first_row: int) -> Optional[pd.DataFrame]:
+    """
+    指定した列の first_row 行目以降だけを、1回のリクエストでまとめて取得する。
+    同じリクエストでヘッダー行も読み、列の位置が columns と食い違っていれば None を返す。
+    """
+    ranges = ['1:1'] + [f"{letter}{first_row}:{letter}" for _, letter in columns]
+    header_range, *value_ranges = worksheet.batch_get(ranges, major_dimension="COLUMNS")
+    header = [cell[0] if cell else '' for cell in header_range]
+    if column_letters(header) != columns:
+        return None
+
+    values = [value_range[0] if value_range else [] for value_range in value_ranges]
+    # 末尾の空セルは省略されて返るため、行数を揃える
+    row_count = max(map(len, values), default=0)
+    return pd.DataFrame({
+        name: col + [''] * (row_count - len(col))
+        for (name, _), col in zip(columns, values)
+    })
+
+@st.cache_data(ttl=CLOSED_PERIOD_TTL)
+def load_closed_periods(sheet_name: str) -> Optional[pd.DataFrame]:
+    """
+    シート先頭から連続する、受注月・納品月がともに締め済みの期に属する行を読み込み、型変換する。
+    管理No.が空の行は読み飛ばすが、最終行は必ず管理No.のある行にする（境界の確認に使う）。
+    返す行数 + 1 がシート上の最終行番号（ヘッダーが1行目）になる。
+    納品月が未入力の行（未納品・失注など）があると、その行以降はすべて進行中の期として扱われる。
+    列の位置が変わっていた場合は None を返す。
+    """
+    worksheet = get_worksheet(sheet_name)
+    df = fetch_columns(worksheet, load_column_letters(sheet_name), 2)
+    if df is None:
+        return None
+    df = convert_sheet_types(df)
+
+    current_start = get_current_fiscal_start()
+    is_blank = (df['管理No.'].str.strip() == '').to_numpy()
+    is_closed = is_blank | ((df["受注月"] < current_start) & (df["納品月"] < current_start)).to_numpy()
+    closed_count = len(is_closed) if is_closed.all() else int(is_closed.argmin())
+    filled_rows = np.flatnonzero(~is_blank[:closed_count])
+    closed_count = int(filled_rows[-1]) + 1 if len(filled_rows) else 0
+    return df.iloc[:closed_count]
+
+@st.cache_data(ttl=CURRENT_PERIOD_TTL)
+def load_current_period(sheet_name: str, anchor_row: int) -> Optional[tuple]:
+    """
+    シートの anchor_row 行目（締め済みの最終行。なければヘッダー行）の管理No.と、
+    その次の行以降（進行中の期を含む行）を型変換したDataFrameの組を返す。
+    列の位置が変わっていた場合は None を返す。
+    """
+    worksheet = get_worksheet(sheet_name)
+    df = fetch_columns(worksheet, load_column_letters(sheet_name), anchor_row)
+    if df is None:
+        return None
+    # 境界の行そのものがなくなっていれば空文字を返し、呼び出し側で不一致として扱う
+    anchor_id = df['管理No.'].iloc[0] if len(df) else ''
+    return anchor_id, convert_sheet_types(df.iloc[1:].reset_index(drop=True))
+
+def load_sheet_slices(sheet_name: str) -> tuple:
+    """
+    締め済みの期の行と進行中の期の行を読み込む。
+    列の挿入・並べ替えがあると列記号が、締め済み部分より上で行の挿入・削除があると
+    境界の行番号がずれる。ヘッダー行と境界の行の管理No.を照合し、食い違えばキャッシュを捨てて読み直す。
+    """
+    for _ in range(2):
+        df_closed = load_closed_periods(sheet_name)
+        current = load_current_period(sheet_name, len(df_closed) + 1) if df_closed is not None else None
+        if current is not None:
+            anchor_id, df_current = current
+            expected_id = df_closed['管理No.'].iloc[-1] if len(df_closed) else '管理No.'
+            if anchor_id == expected_id:
+                return df_closed, df_current
+        load_column_letters.clear()
+        load_closed_periods.clear()
+        load_current_period.clear()
+    raise RuntimeError("読み込み中にスプレッドシートの行または列が変更されました。時間をおいて再読み込みしてください。")
+
+@st.cache_data(ttl=CURRENT_PERIOD_TTL)
+def load_and_process_data(sheet_name: str) -> tuple:
+    """
+    Googleスプレッドシートからデータを読み込み、前処理を行う。
+    前処理済みのDataFrameと、その内容ハッシュ（集計キャッシュのキー）の組を返す。
+    """
+    # 型変換は各ローダー内で済ませているため、更新のたびに処理するのは進行中の期の行だけ
+    frames = load_sheet_slices(sheet_name)
+
+    # 空行は結合前に除く（結合で新しいDataFrameが作られるため、別途コピーは不要）
+    frames = [frame[frame['管理No.'].str.strip() != ''] for frame in frames]
+    df = pd.concat(frames, ignore_index=True)
+
+    df["受注期"] = get_fiscal_period(df["受注月"])
+    df["納品期"] = get_fiscal_period(df["納品月"])
+
+    # フィルターで文字列ではなく整数コードを比較できるようにする（受注期・納品期は作成時点でカテゴリ型）
+    for col in ['商流', '案件フェーズ', '担当者', '営業担当']:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+
+    # 集計キャッシュのキーに使う内容ハッシュ。読み込み時に1回だけ計算する
+    df_key = int(pd.util.hash_pandas_object(df, index=False).sum())
+    return df, df_key
+
+def full_period_index(period_str):
+    """ '第X期' からその期の12ヶ月分の月初日のインデックスを作成する """
+    if not isinstance(period_str, str) or "第" not in period_str:
+        return None
+    period_num = int(period_str.strip('第期'))
+    start_date = pd.Timestamp(year=2022 + period_num, month=4, day=1)
+    return pd.date_range(start_date, periods=12, freq='MS')
+
+@st.cache_data(ttl=CURRENT_PERIOD_TTL)
+def compute_monthly(_df: pd.DataFrame, df_key: int, period: str, shoryu: tuple, phase: tuple, sales: tuple,
+                    date_col: str, period_col: str) -> Optional[pd.DataFrame]:
+    """
+    フィルター条件と営業期で絞り込み、date_col の月ごとの売上・粗利合計を
+    その期の12ヶ月分に揃えて返す。該当データがなければ None を返す。
+    _df はキャッシュキーに含めない（ハッシュしない）ため、必ず load_and_process_data が
+    返したDataFrameと、同時に返された df_key の組で呼び出すこと。
+    """
+    # 選択された期の12ヶ月分の月
+    full_period = full_period_index(period)
+    if full_period is None:
+        return None
+
+    sales_col_1 = '担当者'
+    sales_col_2 = '営業担当'
+
+    sales_set = frozenset(sales)
+    base_filter = (
+        _df["商流"].isin(shoryu).to_numpy() &
+        _df["案件フェーズ"].isin(phase).to_numpy() &
+        (_df[sales_col_1].isin(sales_set).to_numpy() | _df[sales_col_2].isin(sales_set).to_numpy())
+    )
+    # 共通条件に合う行だけを先に取り出し、営業期の判定はその行に対してのみ行う
+    base_view = _df.iloc[np.flatnonzero(base_filter)]
+    df_filtered = base_view[base_view[period_col] == period]
+    if df_filtered.empty:
+        return None
+
+    # 日付を月初に切り捨てた値でそのまま集計する（DatetimeIndexを経由しない）
+    months = df_filtered[date_col].to_numpy().astype('datetime64[M]')
+    df_grouped = pd.DataFrame({
+        '月': months,
+        '売上（税抜）': df_filtered['売上（税抜）'].to_numpy(),
+        '粗利（税抜）': df_filtered['粗利（税抜）'].to_numpy(),
+    }).groupby('月', observed=True, sort=True).sum().reset_index()
+    df_grouped['月'] = df_grouped['月'].astype('datetime64[ns]')
+
+    # 実績のない月を0で埋めて12ヶ月分に揃える
+    return df_grouped.set_index('月').reindex(full_period, fill_value=0).rename_axis('月').reset_index()
+
 try:
-    df = load_and_process_data('営業成績データ')
+    df, df_key = load_and_process_data('営業成績データ')
 
     st.sidebar.header("フィルター")
 
     # --- フィルター部分 ---
-    shoryu_options = df["商流"].dropna().unique().tolist()
+    shoryu_options = df["商流"].cat.categories.tolist()
     selected_shoryu = st.sidebar.multiselect("商流を選択", shoryu_options, default=shoryu_options)
 
-    phase_options = df["案件フェーズ"].dropna().unique().tolist()
+    phase_options = df["案件フェーズ"].cat.categories.tolist()
     selected_phase = st.sidebar.multiselect("案件フェーズを選択", phase_options, default=phase_options)
 
     sales_options = [
@@ -112,56 +306,31 @@ try:
     ]
     selected_sales = st.sidebar.multiselect("担当営業を選択", sales_options, default=sales_options)
     
-    order_periods = df["受注期"].dropna().unique()
-    delivery_periods = df["納品期"].dropna().unique()
+    order_periods = df["受注期"].cat.categories
+    delivery_periods = df["納品期"].cat.categories
     all_periods = sorted(list(set(order_periods) | set(delivery_periods)))
     
     latest_period_index = len(all_periods) - 1 if all_periods else 0
     selected_period = st.sidebar.selectbox("営業期を選択", all_periods, index=latest_period_index)
     
-    sales_col_1 = '担当者' 
-    sales_col_2 = '営業担当' 
-
-    base_filter = (
-        (df["商流"].isin(selected_shoryu)) &
-        (df["案件フェーズ"].isin(selected_phase)) &
-        (df[sales_col_1].isin(selected_sales) | df[sales_col_2].isin(selected_sales))
+    # フィルター条件はソートしたタプルにして、集計結果のキャッシュキーにする
+    filter_key = (
+        tuple(sorted(selected_shoryu)),
+        tuple(sorted(selected_phase)),
+        tuple(sorted(selected_sales)),
     )
 
-    # --- ▼▼▼ グラフ生成ロジックを修正 ▼▼▼ ---
-    def create_full_period_df(period_str):
-        """ '第X期' からその期の12ヶ月分のDataFrameを作成する """
-        if not isinstance(period_str, str) or "第" not in period_str:
-            return None
-        period_num = int(period_str.replace('第','').replace('期',''))
-        start_year = 2022 + period_num
-        start_date = pd.Timestamp(year=start_year, month=4, day=1)
-        # 12ヶ月分の月を生成
-        months = [start_date + relativedelta(months=i) for i in range(12)]
-        return pd.DataFrame({'月': months})
-
     # グラフ描画
     # 1. 受注月ごとの売上・粗利推移（棒グラフ）
     st.subheader(f"{selected_period} 受注月ごとの売上・粗利推移")
     
-    df_order_filtered = df[base_filter & (df["受注期"] == selected_period)]
+    merged_df_order = compute_monthly(df, df_key, selected_period, *filter_key, '受注月', '受注期')
 
-    # 選択された期の12ヶ月分の空のDataFrameを作成
-    full_period_order_df = create_full_period_df(selected_period)
-    
-    if full_period_order_df is not None and not df_order_filtered.empty:
-        df_order_grouped = df_order_filtered.set_index('受注月').groupby(pd.Grouper(freq='M'))[['売上（税抜）', '粗利（税抜）']].sum().reset_index()
-        df_order_grouped.rename(columns={'受注月': '月'}, inplace=True)
-        
-        # 12ヶ月分のデータと実績データを結合
-        merged_df_order = pd.merge(full_period_order_df, df_order_grouped, on='月', how='left').fillna(0)
-        
-        df_order_melted = merged_df_order.melt(id_vars='月', value_vars=['売上（税抜）', '粗利（税抜）'], var_name='指標', value_name='合計値')
-        
+    if merged_df_order is not None:
         fig_order = px.bar(
-            df_order_melted, x='月', y='合計値', color='指標',
-            barmode='group', title="受注ベース 売上・粗利",
-            template="plotly_white", color_discrete_map={'売上（税抜）': '#3b82f6', '粗利（税抜）': '#2dd4bf'}
+            merged_df_order, x='月', y=['売上（税抜）', '粗利（税抜）'],
+            barmode='group', title="受注ベース 売上・粗利", labels={'variable': '指標', 'value': '合計値'},
+            template="plotly_white", color_discrete_sequence=['#3b82f6', '#2dd4bf']
         )
         fig_order.update_layout(
             xaxis_title="受注月", yaxis_title="合計金額", title_font_size=22,
@@ -176,22 +345,13 @@ try:
     # 2. 納品月ごとの売上・粗利推移（折れ線グラフ）
     st.subheader(f"{selected_period} 納品月ごとの売上・粗利推移")
 
-    df_delivery_filtered = df[base_filter & (df["納品期"] == selected_period)]
-    
-    full_period_delivery_df = create_full_period_df(selected_period)
-
-    if full_period_delivery_df is not None and not df_delivery_filtered.empty:
-        df_delivery_grouped = df_delivery_filtered.set_index('納品月').groupby(pd.Grouper(freq='M'))[['売上（税抜）', '粗利（税抜）']].sum().reset_index()
-        df_delivery_grouped.rename(columns={'納品月': '月'}, inplace=True)
-
-        merged_df_delivery = pd.merge(full_period_delivery_df, df_delivery_grouped, on='月', how='left').fillna(0)
-        
-        df_delivery_melted = merged_df_delivery.melt(id_vars='月', value_vars=['売上（税抜）', '粗利（税抜）'], var_name='指標', value_name='合計値')
+    merged_df_delivery = compute_monthly(df, df_key, selected_period, *filter_key, '納品月', '納品期')
 
+    if merged_df_delivery is not None:
         fig_delivery = px.line(
-            df_delivery_melted, x='月', y='合計値', color='指標',
-            title="納品ベース 売上・粗利", markers=True,
-            template="plotly_white", color_discrete_map={'売上（税抜）': '#636EFA', '粗利（税抜）': '#f472b6'}
+            merged_df_delivery, x='月', y=['売上（税抜）', '粗利（税抜）'],
+            title="納品ベース 売上・粗利", markers=True, labels={'variable': '指標', 'value': '合計値'},
+            template="plotly_white", color_discrete_sequence=['#636EFA', '#f472b6']
         )
         fig_delivery.update_layout(
             xaxis_title="納品月", yaxis_title="合計金額", title_font_size=22,